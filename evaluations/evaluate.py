@@ -1,12 +1,8 @@
-import csv
-from collections import defaultdict
-import tqdm
 from matplotlib import pyplot as plt
 import numpy as np
 import os
-import cv2
 
-from metrics import nonzero_masking, remove_noise
+from metrics import nonzero_masking, remove_noise, load_brats_sample, anomaly_map, otsu_threshold
 
 def evaluate_training(progress_dir, save_dir):
     """
@@ -19,94 +15,93 @@ def evaluate_training(progress_dir, save_dir):
     figsize = (12,10)
     warm_up_steps = 4000        #metrics of steps before warmup will not be showed in figure if data shifts too much from center
     skip_metric = ["step", "samples"]        #metrics that are skipped
+    max_points = 2000        #long series are strided down to about this many points
+    dpi = 150
     
     #reading data
-    warm_up_idx = 0
-    metrics = defaultdict(list)
-    with open(progress_dir, 'r') as f:
-        reader = csv.DictReader(f)
-        for row in tqdm.tqdm(reader):
-            if int(row["step"]) < warm_up_steps:
-                warm_up_idx += 1
-                
-            for k, v in row.items():
-                metrics[k].append(float(v))
+    import pandas as pd
+    df = pd.read_csv(progress_dir)
+    warm_up_idx = int((df["step"] < warm_up_steps).sum())
+    metrics = {k: df[k].to_numpy(dtype=np.float64) for k in df.columns}
     
     #visualize
     num_rows = int(np.ceil((len(metrics) - len(set(skip_metric) & set(metrics.keys()))) / num_columns))
+    stride = max(1, len(metrics["step"]) // max_points)
     plt.figure(figsize=figsize)
     
+    steps = metrics["step"]
     idx = 0
-    for metric_name in metrics:
+    for metric_name, values in metrics.items():
         if metric_name in skip_metric:
             continue
         else:
             idx += 1
             plt.subplot(num_rows, num_columns, idx)
-            plt.plot(metrics["step"], metrics[metric_name])
+            plt.plot(steps[::stride], values[::stride])
             plt.title(metric_name)
             plt.xlabel("step")
-            plt.ylim((min(metrics[metric_name][warm_up_idx:])), max(metrics[metric_name][warm_up_idx:]))        
+            plt.ylim(np.nanmin(values[warm_up_idx:]), np.nanmax(values[warm_up_idx:]))        
             
-    plt.savefig(save_dir, dpi=600)
+    plt.savefig(save_dir, dpi=dpi)
     plt.close()
     
-def evaluate_image(image_path, save_dir):
-    data = np.load(image_path)
+def evaluate_image(image_path, save_dir, fig=None):
+    """
+    Visualize the input, generated image and anomaly maps of a sample.
+    Args:
+        image_path: saved sample path
+        save_dir: figure path
+        fig (optional): figure to draw on, it is cleared and kept open so it can be reused between calls.
+            A new figure is created and closed when None.
+    """
     
     def mask_fn(pred, mask, return_thresh=False):
-        masked_pred = pred[np.where(mask > 0)].reshape(1, -1)
-        masked_pred = (masked_pred * 255.0).astype(np.uint8).squeeze()
-        thresh ,_ = cv2.threshold(masked_pred, 0, 255, cv2.THRESH_OTSU)
-        thresh = thresh/255.0
-        pred = (pred > thresh) * 1.0
+        thresh = otsu_threshold(pred[mask > 0])
+        pred = (pred > thresh).astype(np.float32)
         if return_thresh:
             return thresh, pred
         else:
             return pred
-    img = data[np.newaxis,0,:,:,:4]*1.0/255.0
-    seg = np.expand_dims(data[0,:,:,4], axis=(0,-1))
-    generated = data[np.newaxis,0,:,:,5:]*1.0/255.0
-    pred = np.expand_dims(np.mean(np.sqrt((generated-img)**2), axis=3), axis = -1)
+    img, seg, generated = load_brats_sample(image_path)
+    pred = anomaly_map(generated, img)
     pred = remove_noise(pred)
     #change from (0,255) to (0,1)
     pred, mask = nonzero_masking(img, pred, return_mask=True)
     thresh, pred_seg = mask_fn(pred, mask, return_thresh=True)
     
-    pred_modality = remove_noise(np.sqrt((generated-img)**2))
+    pred_modality = remove_noise(np.abs(generated-img))
+    
+    if fig is None:
+        fig = plt.figure()
+        close_fig = True
+    else:
+        fig.clf()
+        close_fig = False
+    axes = fig.subplots(4, 4)
+    for ax in axes.flat:
+        ax.axis('off')
     
     for i in range(4):
-        plt.subplot(4,4,i + 1)
-        plt.imshow(img[0,:,:,i].squeeze(),cmap='gray', vmin=0.0, vmax=1.0)
-        plt.axis('off')
-        plt.title(f'image(channel{i})')
+        axes[0,i].imshow(img[0,:,:,i], cmap='gray', vmin=0.0, vmax=1.0, interpolation='nearest')
+        axes[0,i].set_title(f'image(channel{i})')
     for i in range(4):
-        plt.subplot(4,4,i + 5)
-        plt.imshow(generated[0,:,:,i].squeeze(), cmap='gray', vmin=0.0, vmax=1.0)
-        plt.axis('off')
-        plt.title(f'generated(channel{i})')
+        axes[1,i].imshow(generated[0,:,:,i], cmap='gray', vmin=0.0, vmax=1.0, interpolation='nearest')
+        axes[1,i].set_title(f'generated(channel{i})')
     for i in range(4):
-        plt.subplot(4,4,i + 9)
-        plt.imshow(pred_modality[0,:,:,i].squeeze(), cmap='gray')
-        plt.axis('off')
-        plt.title(f'pred(channel{i})')
-    plt.subplot(4,4,14)
-    plt.imshow((seg > 0 * 1.0).squeeze(),cmap='gray', vmin=0.0, vmax=1.0)
-    plt.axis('off')
-    plt.title('ground truth')
-    plt.subplot(4,4,15)
-    plt.imshow(pred_seg.squeeze(), cmap='gray', vmin=0.0, vmax=1.0)
-    plt.axis('off')
-    plt.title('segmentation')
-    plt.subplot(4,4,16)
-    plt.imshow((pred * pred_seg).squeeze(), cmap='Spectral_r', vmin=0.0, vmax=1.0)
-    plt.colorbar()
+        axes[2,i].imshow(pred_modality[0,:,:,i], cmap='gray', interpolation='nearest')
+        axes[2,i].set_title(f'pred(channel{i})')
+    axes[3,1].imshow((seg > 0 * 1.0).squeeze(), cmap='gray', vmin=0.0, vmax=1.0, interpolation='nearest')
+    axes[3,1].set_title('ground truth')
+    axes[3,2].imshow(pred_seg.squeeze(), cmap='gray', vmin=0.0, vmax=1.0, interpolation='nearest')
+    axes[3,2].set_title('segmentation')
+    im = axes[3,3].imshow((pred * pred_seg).squeeze(), cmap='Spectral_r', vmin=0.0, vmax=1.0, interpolation='nearest')
+    fig.colorbar(im, ax=axes[3,3])
     #plt.imshow(img.squeeze().astype(np.uint), cmap='gray', alpha=0.5)
-    plt.axis('off')
-    plt.title('image+segmentation')
-    plt.savefig(save_dir)
+    axes[3,3].set_title('image+segmentation')
+    fig.savefig(save_dir)
     print("threshold:", thresh)
-    plt.close
+    if close_fig:
+        plt.close(fig)
     
 def evaluate_z(data_path, output_path):
     data = np.load(data_path)
@@ -115,7 +110,11 @@ def evaluate_z(data_path, output_path):
     labels = data['all_labels'].squeeze()
     
     from sklearn import manifold
-    tsne = manifold.TSNE()
+    from sklearn.decomposition import TruncatedSVD
+    #reduce high dimensional z before t-SNE, whose cost per iteration grows with the input dimension
+    if zs.shape[1] > 50:
+        zs = TruncatedSVD(n_components=50).fit_transform(zs)
+    tsne = manifold.TSNE(n_jobs=-1, init='pca', learning_rate='auto', perplexity=30)
     z_tsne = tsne.fit_transform(zs)
     
     z_min, z_max = z_tsne.min(0), z_tsne.max(0)
@@ -1,18 +1,21 @@
 import torch
-from sklearn.metrics import roc_auc_score
+from scipy.stats import rankdata
 import numpy as np
 from typing import Union
 import os
 import csv
+import multiprocessing
+from contextlib import nullcontext
 from functools import partial
 from tqdm import tqdm
+from numba import njit, prange, set_num_threads
 
 ImageClass = Union[torch.Tensor,np.ndarray]
 
 def dice_coeff(
     targets:ImageClass, 
     images:ImageClass,
-    mask_fn=lambda x:x,
+    mask_fn=None,
     epsilon=1e-6
 ):
     """
@@ -21,35 +24,58 @@ def dice_coeff(
     Args:
         images (torch.Tensor|np.ndarray): input image of (N,1,H,W) or (N,H,W,1)
         targets (torch.Tensor|np.ndarry): ground truth, should share the same shape as input
+        mask_fn (optional): function applied to every single image before calculation. Defaults to None.
         epsilon (optional): a small number added to the denominator. Defaults to 1e-6.
     """
     assert images.shape == targets.shape and type(images) == type(targets),\
          "the input and target images should share the same shape and type"
-    dice = 0
-    dot_fn = torch.dot if type(images) == torch.Tensor else np.dot
-    for image, target in zip(images, targets):
-        image = mask_fn(image)
-        dot = dot_fn(image.reshape(-1), target.reshape(-1))
-        sum = image.sum() + target.sum()
-        dice += (2 * dot + epsilon) / (sum + epsilon)
+    if mask_fn is not None:
+        stack_fn = torch.stack if isinstance(images, torch.Tensor) else np.stack
+        images = stack_fn([mask_fn(image) for image in images])
         
-    dice = dice / images.shape[0]
+    axes = tuple(range(1, images.ndim))
+    dot = (images * targets).sum(axes)
+    sum = images.sum(axes) + targets.sum(axes)
+    dice = ((2 * dot + epsilon) / (sum + epsilon)).mean()
     return dice
 
+def region_mask(targets:ImageClass, region_type='WT'):
+    """
+    get the mask of a tumor region (ET, TC or WT) from the segmentation labels
+    """
+    assert region_type in ["ET", "TC", "WT"], "region type should be one of ET, TC, WT"
+    if region_type == 'ET':
+        return targets == 1
+    elif region_type == "TC":
+        return (targets == 1) | (targets == 4)
+    else:
+        return (targets == 1) | (targets == 2) | (targets == 4)
+
 def region_specific_metrics(
     targets:ImageClass, 
     images:ImageClass, 
     func,
     region_type='WT',
+    region_masks=None,
     **func_kwargs
 ):
-    assert region_type in ["ET", "TC", "WT"], "region type should be one of ET, TC, WT"
-    if region_type == 'ET':
-        masks = (targets == 1) * 1
-    elif region_type == "TC":
-        masks = (((targets == 1) + (targets == 4)) > 0) * 1
+    """
+    calculate func on a tumor region
+
+    Args:
+        targets (torch.Tensor|np.ndarray): segmentation labels
+        images (torch.Tensor|np.ndarray): prediction, should share the same shape as targets
+        func: metric called as func(region mask, images, **func_kwargs)
+        region_type (optional): one of ET, TC, WT. Defaults to 'WT'.
+        region_masks (dict, optional): region masks of targets already computed, shared by the metrics of
+            the same targets so every region is computed once. New masks are added to it. Defaults to None.
+    """
+    if region_masks is None:
+        masks = region_mask(targets, region_type)
     else:
-        masks = (((targets == 1) + (targets == 2) + (targets == 4))) > 0 * 1
+        if region_type not in region_masks:
+            region_masks[region_type] = region_mask(targets, region_type)
+        masks = region_masks[region_type]
         
     return func(masks, images, **func_kwargs)
 
@@ -64,25 +90,30 @@ def AUROC(
     Args:
         images (torch.Tensor|np.ndarray): input image of (N,1,H,W) or (N,H,W,1)
         targets (torch.Tensor|np.ndarray): ground truth, should share the same shape as input
-        "minimal number of pixel for a anomaly image to be considered as anomalous"
+        threshold (optional): minimal number of pixel for a anomaly image to be considered as anomalous,
+            images under it are skipped and -1 is returned if no image is left. Defaults to 200.
     """
     assert images.shape == targets.shape and type(images) == type(targets),\
          "the input and target images should share the same shape and type"
          
-    score = 0
-    for image, target in zip(images, targets):
-        if isinstance(images, torch.Tensor):     
-            target = target.detach().cpu().to(torch.uint8).numpy().flatten().squeeze()
-            image = image.detach().cpu().numpy().flatten().squeeze()
-        else:
-            target = target.flatten().squeeze()
-            image = image.flatten().squeeze()
-        if target.sum() <= threshold:
-            score = -1
-        else: 
-            score+=(roc_auc_score(target, image))
-        
-    return score/images.shape[0]
+    if isinstance(images, torch.Tensor):
+        targets = targets.detach().cpu().to(torch.uint8).numpy()
+        images = images.detach().cpu().numpy()
+    targets = targets.reshape(targets.shape[0], -1).astype(np.float32)
+    images = images.reshape(images.shape[0], -1)
+    
+    #Mann-Whitney U statistic over the whole batch: AUC = (R_pos - n_pos(n_pos+1)/2) / (n_pos*n_neg)
+    ranks = rankdata(images, axis=1, method='average')
+    n_pos = targets.sum(axis=1)
+    n_neg = targets.shape[1] - n_pos
+    pos_rank_sum = (ranks * targets).sum(axis=1)
+    
+    valid = (n_pos > threshold) & (n_neg > 0)
+    if not valid.any():
+        return -1
+    
+    scores = (pos_rank_sum[valid] - n_pos[valid] * (n_pos[valid] + 1) / 2) / (n_pos[valid] * n_neg[valid])
+    return scores.mean()
 
 def min_max_scale(image:ImageClass):
     return (image - image.min())/(image.max()-image.min())
@@ -97,12 +128,13 @@ def nonzero_masking(images:ImageClass, targets:ImageClass, return_mask=False):
     Args:
         images (torch.Tensor|np.ndarray): input image of (N,1,H,W) or (N,H,W,1)
         targets (torch.Tensor|np.ndarray): ground truth, should share the same shape as input
-        return_mask (bool): whether to return the mask
+        return_mask (bool): whether to return the (boolean) mask
     """
     assert type(images) == type(targets),\
         "the input and target images should share the same and type"
     if isinstance(images, torch.Tensor):
         sum_kwargs = {"dim":1, "keepdim": True}
+        where_fn = torch.where
         assert images.shape[2:] == targets.shape[2:],\
             f"the input and target images should share the same shape(H,W) get image: {images.shape[2:]} and target: {targets.shape[2:]} "  
             
@@ -111,19 +143,159 @@ def nonzero_masking(images:ImageClass, targets:ImageClass, return_mask=False):
         assert images.shape[1:3] == targets.shape[1:3],\
             f"the input and target images should share the same shape(H,W), get image: {images.shape[1:3]} and target: {targets.shape[1:3]}"
         sum_kwargs = {"axis":3, "keepdims": True}
+        where_fn = np.where
             
-    mask = ((images > images.min() * 1.0).sum(**sum_kwargs) == 4) * 1.0
+    mask = (images > images.min()).sum(**sum_kwargs) == 4
     
-    targets = targets * mask + targets.min() * (1 - mask)
+    targets = where_fn(mask, targets, targets.min())
     
     if return_mask:
         return targets, mask
     else:
         return targets
         
+@njit(cache=True, parallel=True)
+def _remove_noise_flat(x, lo, hi, out):
+    for i in prange(x.size):
+        v = x[i]
+        out[i] = v if (v >= lo and v <= hi) else 0.0
+
 def remove_noise(image):
-    mask = (image >= np.percentile(image, 1)) * (image <= np.percentile(image, 99)) * 1.0
-    return image * mask
+    """
+    set the pixels outside of the 1st-99th percentile range to zero
+    """
+    flat = np.ascontiguousarray(image).ravel()
+    #quickselect both percentiles in one O(N) pass instead of sorting the whole image
+    k1, k2 = int(0.01 * flat.size), int(0.99 * flat.size)
+    part = np.partition(flat, [k1, k2])
+    lo, hi = part[k1], part[k2]
+    out = np.empty_like(flat)
+    _remove_noise_flat(flat, lo, hi, out)
+    return out.reshape(image.shape)
+
+@njit(cache=True, parallel=True)
+def _anomaly_map(gen, img, out):
+    N, H, W, C = img.shape
+    for nh in prange(N * H):
+        n, h = nh // H, nh % H
+        for w in range(W):
+            s = 0.0
+            for c in range(C):
+                s += abs(gen[n, h, w, c] - img[n, h, w, c])
+            out[n, h, w, 0] = s / C
+
+@njit('void(f4[:,:,:,::1], f4[:,:,:,::1], f4[:,:,:,::1])', cache=True, parallel=True, fastmath=True, boundscheck=False)
+def _anomaly_map_4(gen, img, out):
+    #BraTS has 4 modalities, the unrolled channel sum vectorizes over w
+    N, H, W, _ = img.shape
+    for nh in prange(N * H):
+        n, h = nh // H, nh % H
+        for w in range(W):
+            out[n, h, w, 0] = (abs(gen[n, h, w, 0] - img[n, h, w, 0]) + abs(gen[n, h, w, 1] - img[n, h, w, 1])
+                               + abs(gen[n, h, w, 2] - img[n, h, w, 2]) + abs(gen[n, h, w, 3] - img[n, h, w, 3])) * np.float32(0.25)
+
+def anomaly_map(generated, img):
+    """
+    calculate the anomaly map as the mean absolute difference over channels, in a single fused pass
+
+    Args:
+        generated (np.ndarray): generated image of (N,H,W,C)
+        img (np.ndarray): input image, should share the same shape as generated
+
+    Returns:
+        np.ndarray: anomaly map of (N,H,W,1) in float32
+    """
+    assert generated.shape == img.shape, "the generated and input images should share the same shape"
+    generated = np.ascontiguousarray(generated, dtype=np.float32)
+    img = np.ascontiguousarray(img, dtype=np.float32)
+    out = np.empty(img.shape[:3] + (1,), dtype=np.float32)
+    if img.shape[3] == 4:
+        _anomaly_map_4(generated, img, out)
+    else:
+        _anomaly_map(generated, img, out)
+    return out
+
+def otsu_threshold(values):
+    """
+    find the otsu threshold of values among [0,1] on their 256-level histogram
+
+    bin k holds the values in [k/255, (k+1)/255), the same levels cv2 sees after casting (values*255) to uint8,
+    so the result matches cv2.threshold(..., cv2.THRESH_OTSU)/255 without the uint8 round-trip
+
+    Args:
+        values (np.ndarray): values to be thresholded, of any shape
+    """
+    hist, _ = np.histogram(values, bins=256, range=(0.0, 256/255))
+    p = hist / hist.sum()
+    omega = np.cumsum(p)
+    mu = np.cumsum(p * np.arange(256))
+    sigma_b = (mu[-1] * omega - mu) ** 2 / (omega * (1 - omega) + 1e-12)
+    return np.argmax(sigma_b) / 255.0
+
+def load_brats_sample(file_dir):
+    """
+    load a saved sample of (1,H,W,9) (image, segmentation, generated image along the last axis)
+    
+    the file is memory-mapped and the images are converted to float32 in [0,1] directly, so every channel is read a single time
+
+    Returns:
+        img (np.ndarray): input image of (1,H,W,4)
+        seg (np.ndarray): ground truth of (1,H,W,1)
+        generated (np.ndarray): generated image of (1,H,W,4)
+    """
+    data = np.load(file_dir, mmap_mode='r')
+    img = data[0:1,:,:,:4].astype(np.float32) * np.float32(1/255.0)
+    seg = np.array(data[0:1,:,:,4:5])
+    generated = data[0:1,:,:,5:].astype(np.float32) * np.float32(1/255.0)
+    return img, seg, generated
+
+def _preprocess_and_cache(file_dir, use_cache=True):
+    """
+    compute the anomaly map and the brain mask of a saved sample, reusing f"{file_dir}.prep.npz" when it is up to date
+    
+    the anomaly map is stored as float16 and the mask as uint8; the returned values are always the stored ones
+    so cached and freshly computed runs give identical metrics
+
+    Returns:
+        seg (np.ndarray): ground truth of (1,H,W,1)
+        pred (np.ndarray): anomaly map of (1,H,W,1), before masking
+        mask (np.ndarray): non-zero mask of the input image of (1,H,W,1)
+    """
+    cache_dir = f"{file_dir}.prep.npz"
+    if use_cache and os.path.exists(cache_dir) and os.path.getmtime(cache_dir) >= os.path.getmtime(file_dir):
+        with np.load(cache_dir) as cache:
+            return cache["seg"], cache["pred"].astype(np.float32), cache["mask"]
+    
+    img, seg, generated = load_brats_sample(file_dir)
+    pred = anomaly_map(generated, img).astype(np.float16)
+    _, mask = nonzero_masking(img, pred, return_mask=True)
+    mask = mask.astype(np.uint8)
+    
+    if use_cache:
+        try:
+            np.savez(cache_dir, seg=seg, pred=pred, mask=mask)
+        except OSError:
+            #e.g. a read-only data folder, evaluate without caching
+            pass
+    return seg, pred.astype(np.float32), mask
+
+def _call_metric(metric_fn, seg, pred, region_masks):
+    #only partials of region_specific_metrics share the region masks, other metrics are called as metric_fn(seg, pred)
+    if isinstance(metric_fn, partial) and metric_fn.func is region_specific_metrics:
+        return metric_fn(seg, pred, region_masks=region_masks)
+    return metric_fn(seg, pred)
+
+def _init_worker():
+    #every worker handles whole files, avoid oversubscribing the cores with numba threads
+    set_num_threads(1)
+
+def _process_one(file_name, data_folder, metrics, use_cache=True):
+    file_dir = os.path.join(data_folder, file_name)
+    seg, pred, mask = _preprocess_and_cache(file_dir, use_cache)
+    pred = np.where(mask > 0, pred, pred.min())
+    
+    region_masks = {}
+    return file_name, [_call_metric(metric_fn, seg, pred, region_masks) for metric_fn in metrics.values()]
 
 class BratsEvaluator():
     def __init__(
@@ -131,56 +303,71 @@ class BratsEvaluator():
         data_folder,
         metrics,
         mask_fn=None,
+        use_cache=True,
     ):  
+        """
+        Args:
+            data_folder: generated results folder
+            metrics (dict): metric name -> metric_fn(seg, pred). Partials of region_specific_metrics additionally
+                get the region masks shared between the metrics of a file.
+            mask_fn (optional): thresholding function used by finding_threshold. Defaults to None.
+            use_cache (optional): whether to reuse preprocessed samples cached next to them. Defaults to True.
+        """
         self.data_folder = data_folder
         self.metrics = metrics
         self.mask_fn = (lambda x: x) if mask_fn is None else mask_fn
+        self.use_cache = use_cache
         
         self.data_files = [file_name for file_name in os.listdir(self.data_folder) if file_name.endswith(".npy")]
         
-    def evaluate_images(self,output_dir, store_data=True, use_tqdm=False):
+    def evaluate_images(self,output_dir, store_data=True, use_tqdm=False, num_workers=None):
+        """
+        evaluate every file, in parallel when num_workers > 1 (defaults to one per core, at most one per file),
+        in which case self.metrics should be picklable (e.g. partials of module level functions)
+        """
+        
+        metric_names = list(self.metrics.keys())
+        auroc_idx = metric_names.index("AUROC_WT")
         
         if store_data:
             if not os.path.exists(output_dir):
                 os.makedirs(output_dir)
-            csvfile = open(os.path.join(output_dir,"metrics.csv"), 'w', newline='')
-            fieldnames = ['file_name', 'threshold']+list(self.metrics.keys())
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
+            csvfile = open(os.path.join(output_dir,"metrics.csv"), 'w', newline='', buffering=1<<20)
+            writer = csv.writer(csvfile)
+            writer.writerow(['file_name', 'threshold']+metric_names)
+            rows = []
                 
-        metrics_imgs = {metric:[] for metric in self.metrics}
+        metrics_imgs = np.empty((len(self.data_files), len(metric_names)))
+        num_imgs = 0
         
-        iterf = tqdm(self.data_files) if  use_tqdm else self.data_files
+        num_workers = min(os.cpu_count(), len(self.data_files)) if num_workers is None else num_workers
+        process_fn = partial(_process_one, data_folder=self.data_folder, metrics=self.metrics, use_cache=self.use_cache)
+        #spawn rather than fork, forking after numba has started its threads can hang the main process
+        #every spawned worker imports torch and numba again, so a single worker runs in this process instead
+        pool_context = multiprocessing.get_context("spawn").Pool(num_workers, initializer=_init_worker) if num_workers > 1 else nullcontext()
+        with pool_context as pool:
+            iterf = map(process_fn, self.data_files) if pool is None else pool.imap_unordered(process_fn, self.data_files)
+            iterf = tqdm(iterf, total=len(self.data_files)) if use_tqdm else iterf
               
-        for file_name in iterf:
-            file_dir = os.path.join(self.data_folder, file_name)
-            data = np.load(file_dir)
-            
-            img = data[np.newaxis,0,:,:,:4]*1.0/255.0
-            seg = np.expand_dims(data[0,:,:,4], axis=(0,-1))
-            generated = data[np.newaxis,0,:,:,5:]*1.0/255.0
-            pred = np.expand_dims(np.mean(np.sqrt((generated-img)**2), axis=3), axis = -1)
-            
-            
-            pred = nonzero_masking(img, pred)
-            
-            metrics_img = {metric: metric_fn(seg,pred) for metric, metric_fn in self.metrics.items()}
-            metrics_img["file_name"] = file_name
-            
-            #filter the images that have no anomalies
-            if metrics_img["AUROC_WT"] == -1:
-                continue
-            
-            if store_data:
-                writer.writerow(metrics_img)
-            
-            for key in metrics_imgs:
-                metrics_imgs[key].append(metrics_img[key])
+            for file_name, metrics_img in iterf:
+                #filter the images that have no anomalies
+                if metrics_img[auroc_idx] == -1:
+                    continue
+                
+                if store_data:
+                    rows.append((file_name, '', *metrics_img))
+                    if len(rows) >= 64:
+                        writer.writerows(rows)
+                        rows.clear()
+                
+                metrics_imgs[num_imgs] = metrics_img
+                num_imgs += 1
         
         if store_data:
+            writer.writerows(rows)
             csvfile.close()
                         
-        metrics = {k:(np.mean(v), np.std(v)) for k,v in metrics_imgs.items()}
+        metrics = {k:(np.mean(metrics_imgs[:num_imgs, i]), np.std(metrics_imgs[:num_imgs, i])) for i, k in enumerate(metric_names)}
         return metrics
                 
     def finding_threshold(self, use_tqdm=False):
@@ -190,24 +377,22 @@ class BratsEvaluator():
         
         iterf = tqdm(self.data_files) if  use_tqdm else self.data_files
         
+        #the lambda looks up `mask` when called, so it always uses the mask of the current file
+        #a copy is used so self.metrics stays picklable for evaluate_images
+        metrics = dict(self.metrics)
+        metrics["DICE_WT"] = partial(region_specific_metrics, func=dice_coeff, region_type="WT",
+                                          mask_fn=lambda x: self.mask_fn(x, mask=mask.squeeze(0)))
+        
         max_min_dict = {"max_DICE":0, "max_DICE_file":None,"max_DICE_thresh":0,"min_DICE":1, "min_DICE_file":None, "min_DICE_thresh":0}
         for file_name in iterf:
             file_dir = os.path.join(self.data_folder, file_name)
-            data = np.load(file_dir)
-            
-            img = data[np.newaxis,0,:,:,:4]*1.0/255.0
-            seg = np.expand_dims(data[0,:,:,4], axis=(0,-1))
-            generated = data[np.newaxis,0,:,:,5:]*1.0/255.0
-            pred = np.expand_dims(np.mean(np.sqrt((generated-img)**2), axis=3), axis = -1)
+            seg, pred, mask = _preprocess_and_cache(file_dir, self.use_cache)
             pred = remove_noise(pred)
-            pred, mask = nonzero_masking(img, pred, return_mask=True)
+            pred = np.where(mask > 0, pred, pred.min())
             thresh, _ = self.mask_fn(pred, mask, return_thresh=True)
             
-            mask_fn = partial(self.mask_fn, mask=mask.squeeze(0))
-
-            self.metrics["DICE_WT"] = partial(region_specific_metrics, func=dice_coeff, region_type="WT", mask_fn=mask_fn)
-            
-            metrics_img = {metric: metric_fn(seg,pred) for metric, metric_fn in self.metrics.items()}
+            region_masks = {}
+            metrics_img = {metric: _call_metric(metric_fn, seg, pred, region_masks) for metric, metric_fn in metrics.items()}
             metrics_img["file_name"] = file_name
             metrics_img['threshold'] = thresh
             
@@ -238,15 +423,11 @@ def finding_threshold(data_folder, output_dir):
         data_folder: generated results folder
         output_dir: output directory
     """
-    import cv2
     import pandas as pd
     
     def mask_fn(pred, mask, return_thresh=False):
-        masked_pred = pred[np.where(mask > 0)].reshape(1, -1)
-        masked_pred = (masked_pred * 255.0).astype(np.uint8).squeeze()
-        thresh ,_ = cv2.threshold(masked_pred, 0, 255, cv2.THRESH_OTSU)
-        thresh = thresh/255.0
-        pred = (pred > thresh) * 1.0
+        thresh = otsu_threshold(pred[mask > 0])
+        pred = (pred > thresh).astype(np.float32)
         if return_thresh:
             return thresh, pred
         else:
@@ -274,13 +455,15 @@ def finding_threshold(data_folder, output_dir):
     pd.set_option("display.max_rows", None)
     print(df)
     
+def threshold_mask(pred, thresh):
+    return (pred >= thresh).astype(np.float32)
+    
 def using_thresh(data_folder, output_dir, thresh=0.0817678607279089):
     import pandas as pd
     
     metrics_threshs = {'threshold':thresh}
     
-    def mask_fn(pred):
-        return (pred >= metrics_threshs['threshold']) * 1.0
+    mask_fn = partial(threshold_mask, thresh=thresh)
     
     metrics = {
         "DICE_WT": partial(region_specific_metrics, func=dice_coeff, region_type="WT", mask_fn=mask_fn),
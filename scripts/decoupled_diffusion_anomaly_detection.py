@@ -64,20 +64,45 @@ def main():
         return model.predict_with_Z(x, t, z)
     
     if args.shifting_z:
+        # z' = ((z - z_mean)/z_std + s*w) * z_std + z_mean with s = (anomaly_score - b - z_norm@w^T)/(w@w^T)
+        # is affine in z, so it is folded into a single linear layer once
+        #s = (median - b - th.mm(z, w.transpose(0,1)))/(th.mm(w,(w.transpose(0,1))))
+        w_flat = w.reshape(1, -1)
+        z_mean, z_std = z_mean.reshape(-1), z_std.reshape(-1)
+        wwT = th.mm(w_flat, w_flat.transpose(0,1)).item()
+        proj = th.eye(w_flat.shape[1], device=w.device) - th.mm(w_flat.transpose(0,1), w_flat) / wwT
+        shift = (args.anomaly_score - b) / wwT * w_flat
+        shift_weight = (proj * z_std[None,:] / z_std[:,None]).transpose(0,1).contiguous()
+        shift_bias = ((shift - th.mm((z_mean / z_std)[None,:], proj)) * z_std + z_mean).reshape(-1)
+        
         def shiftingZ(z:th.Tensor):
-            z = (z - z_mean)/z_std
-            #s = (median - b - th.mm(z, w.transpose(0,1)))/(th.mm(w,(w.transpose(0,1))))
-            s = (args.anomaly_score - b - th.mm(z, w.transpose(0,1)))/(th.mm(w,(w.transpose(0,1))))
-            z = z + s * w
-            z = z * z_std + z_mean
-
-            return z
+            return F.linear(z, shift_weight, shift_bias)
     else:
         def shiftingZ(z:th.Tensor):
             return z
     logger.log("testing...")
     
     all_images = []
+    all_preds = []
+    all_masks = []
+    num_samples = 0
+    num_batches = 0
+    save_sample = None
+    # two pinned staging slots used in turn, so a batch is copied to the host while the next one is sampled
+    staging = [None, None]
+    pending = [None, None]
+    
+    def drain(slot):
+        # wait for the copy in a staging slot and move it to pageable memory so the slot can be reused
+        if pending[slot] is None:
+            return
+        pending[slot].synchronize()
+        pending[slot] = None
+        images, preds, masks = staging[slot]
+        all_images.append(images.numpy().copy())
+        all_preds.append(preds.numpy().copy())
+        all_masks.append(masks.numpy().copy())
+    
     sample_fn = (
         diffusion.ddpm_anomaly_detection if not args.use_ddim else diffusion.ddim_anomaly_detection
     )
@@ -113,27 +138,63 @@ def main():
             seg = float2uint(extra["seg"], rescale=False).to(dist_util.dev())
             img_batch = float2uint(img_batch, rescale=True)
 
-            save_sample = th.concat([img_batch,seg,sample],dim=3)
+            # the loader drops the last incomplete batch, so the output buffers are allocated once and reused
+            if save_sample is None:
+                # channel layout of a saved sample: image, segmentation, generated image
+                seg_start = img_batch.shape[3]
+                gen_start = seg_start + seg.shape[3]
+                num_channels = gen_start + sample.shape[3]
+                save_sample = th.empty(*img_batch.shape[:3], num_channels, dtype=th.uint8, device=img_batch.device)
+                if dist.get_rank() == 0:
+                    gathered = th.empty(save_sample.shape[0] * dist.get_world_size(), *save_sample.shape[1:],
+                                        dtype=save_sample.dtype, device=save_sample.device)
+                    gathered_samples = list(gathered.chunk(dist.get_world_size()))
+            save_sample[...,:seg_start] = img_batch
+            save_sample[...,seg_start:gen_start] = seg
+            save_sample[...,gen_start:] = sample
+            num_samples += save_sample.shape[0] * dist.get_world_size()
             
-            gathered_samples = [th.zeros_like(save_sample) for _ in range(dist.get_world_size())]
-            dist.all_gather(gathered_samples, save_sample)  # gather not supported with NCCL
-            all_images.extend([save_sample.cpu().numpy() for save_sample in gathered_samples])
+            # only rank 0 writes the results, so gather to it instead of all ranks
+            if dist.get_rank() == 0:
+                dist.gather(save_sample, gathered_samples, dst=0)
+                pred, mask = compute_pred(gathered[...,:seg_start], gathered[...,gen_start:])
+                
+                slot = num_batches % 2
+                drain(slot)
+                if staging[slot] is None:
+                    staging[slot] = tuple(
+                        th.empty(x.shape, dtype=x.dtype, pin_memory=th.cuda.is_available()) for x in (gathered, pred, mask)
+                    )
+                for host, device in zip(staging[slot], (gathered, pred, mask)):
+                    host.copy_(device, non_blocking=True)
+                pending[slot] = th.cuda.Event()
+                pending[slot].record()
+            else:
+                dist.gather(save_sample, dst=0)
+            num_batches += 1
     
-    arr = np.concatenate(all_images, axis=0)
+    # the older slot holds the earlier batch
+    drain(num_batches % 2)
+    drain((num_batches + 1) % 2)
     end.record()
     th.cuda.synchronize()
     th.cuda.current_stream().synchronize()
     time_taken = start.elapsed_time(end)
-    logger.log(f"Take {time_taken}s to test {len(arr)} samples")
+    logger.log(f"Take {time_taken}s to test {num_samples} samples")
     
     if dist.get_rank() == 0:
         logger.log(f"saving to {logger.get_dir()}")
-        for idx, sample in enumerate(arr):
+        arr = np.concatenate(all_images, axis=0)
+        preds = np.concatenate(all_preds, axis=0)
+        masks = np.concatenate(all_masks, axis=0)
+        for idx in range(len(arr)):
 
-            save_arr = arr[idx][None,...]
+            save_arr = arr[idx:idx+1]
             
             out_path = os.path.join(logger.get_dir(), f"samples_{idx}.npy")
             np.save(out_path, save_arr)
+            # same layout as the preprocessing cache of evaluations/metrics.py, so evaluation skips recomputing it
+            np.savez(f"{out_path}.prep.npz", seg=save_arr[...,seg_start:gen_start], pred=preds[idx:idx+1], mask=masks[idx:idx+1])
 
     dist.barrier()
     logger.log("anomaly detection complete")
@@ -165,6 +226,21 @@ def create_argparser():
     add_dict_to_argparser(parser, defaults)
     return parser
 
+def compute_pred(img:th.Tensor, generated:th.Tensor):
+    """
+    compute the anomaly map and the non-zero mask of uint8 images of (N,H,W,C) on their device
+
+    Returns:
+        pred (th.Tensor): mean absolute difference over channels of (N,H,W,1) in float16
+        mask (th.Tensor): pixels where every channel is above the image minimum, of (N,H,W,1) in uint8
+    """
+    img = img.float() / 255.0
+    generated = generated.float() / 255.0
+    pred = (generated - img).abs().mean(dim=3, keepdim=True)
+    img_min = img.amin(dim=(1,2,3), keepdim=True)
+    mask = (img > img_min).sum(dim=3, keepdim=True) == img.shape[3]
+    return pred.to(th.float16), mask.to(th.uint8)
+
 def float2uint(input:th.Tensor, rescale=True):
     if rescale:
         input = ((input + 1) * 127.5).clamp(0, 255).to(th.uint8)